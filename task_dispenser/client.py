@@ -2,6 +2,17 @@ from typing import Any
 import json
 import redis
 
+from .utils import get_pending_key
+
+
+# Push item only if it is not pending yet. Set membership and push are done atomically.
+ADD_UNIQUE_SCRIPT = '''
+if redis.call('sadd', KEYS[2], ARGV[1]) == 1 then
+    return redis.call('lpush', KEYS[1], ARGV[1])
+end
+return 0
+'''
+
 
 class DispenserClient:
     """
@@ -27,13 +38,18 @@ class DispenserClient:
         Initialize connecion to redis.
         """
         self.r = redis.Redis(host=self.host, port=self.port, decode_responses=True, password=self.password)
+        self._add_unique = self.r.register_script(ADD_UNIQUE_SCRIPT)
 
-    def add(self, qname: str, args: Any) -> Any:
+    def add(self, qname: str, args: Any, unique: bool = False) -> Any:
         """
         Add task to queue.
 
         :param qname: queue name
         :param args: task arguments
+        :param unique: skip task if the same arguments are already pending in queue
         """
         assert self.r is not None, 'Redis not connected. Call client.setip()'
-        return self.r.lpush(qname, json.dumps(args, sort_keys=True, ensure_ascii=False))
+        item = json.dumps(args, sort_keys=True, ensure_ascii=False)
+        if unique:
+            return self._add_unique(keys=[qname, get_pending_key(qname)], args=[item])
+        return self.r.lpush(qname, item)
@@ -1,23 +1,44 @@
 import subprocess as sp
 from contextlib import _GeneratorContextManager
-from typing import Any, Callable, cast, reveal_type, Generator
-from types import TracebackType
+from typing import Any, Callable, Collection, cast, reveal_type, Generator
+from types import TracebackType, FrameType
 import multiprocessing as mp
+import multiprocessing.pool
+import functools
+import itertools
+import threading
+import signal
+import uuid
 import time
 import json
 import redis
+from redis.commands.core import Script
 import logging
 
 logger = logging.getLogger(__file__)
 
 from .utils import (
     start_redis, noop_ctx, raise_error, ErrorWrapper, ErrorHandler, get_error_handler, TaskFailed,
+    get_pending_key, dedup_items, ShutdownRequested, CancellableTask,
 )
+from .ratelimit import RateLimit, TokenBucket
+from .hooks import Hooks, Span
 
 
 def get_delay(
-        flush_interval: float, next_flush_times: dict[str, float | None], max_llen: int, now: float | None = None
+        flush_interval: float, next_flush_times: dict[str, float | None], max_llen: int, now: float | None = None,
+        throttled: dict[str, float] | None = None,
         ) -> tuple[float | None, float]:
+    """
+    Get delay until the next queue flush. Queue rate limited until `throttled[qname]` is not flushed before.
+
+    >>> get_delay(1, {'q1': 12, 'q2': None}, 5, now=10)
+    (2, 10)
+    >>> get_delay(1, {'q1': 12, 'q2': None}, 5, now=10, throttled={'q1': 13, 'q2': 11})
+    (1, 10)
+    >>> get_delay(1, {'q1': 12}, 5, now=13)
+    (0, 13)
+    """
 
     if now is None:
         now = time.time()
@@ -25,36 +46,55 @@ def get_delay(
     if max_llen == 0:
         return None, now
 
+    if throttled is None:
+        throttled = {}
+
     next_flush_time = min(
-        (next_flush_time for next_flush_time in next_flush_times.values() if next_flush_time is not None),
+        (
+            max(flush_time, throttled.get(qname, flush_time)) if flush_time is not None else throttled[qname]
+            for qname, flush_time in next_flush_times.items() if flush_time is not None or qname in throttled
+        ),
         default=None)
 
     if next_flush_time is None:
         return None, now
 
-    delay = next_flush_time - now
-
-    assert delay >= 0, (delay, flush_interval, next_flush_times, max_llen, now)
+    # Flush time may pass while other queues are processed
+    delay = max(next_flush_time - now, 0)
     return delay, now
 
 
-def rpopn(r: redis.Redis, n: int, qname: str) -> Any:  # type: ignore
-    """pop n items from redis list queue"""
-
-    with r.pipeline(transaction=True) as pipe:
-        items, status = (
-            pipe
-            .lrange(qname, -n, -1)
-            .ltrim(qname, 0, -n -1)
-            .execute()
-        )
-
-        assert status
-    return items
+# Pop items and release them from pending set atomically, so unique task added right after pop is not skipped.
+# Queues without unique tasks have no pending set and pay only for `exists` check.
+# Items are removed by chunks to stay within lua stack limit.
+RPOPN_SCRIPT = '''
+local n = tonumber(ARGV[1])
+local items = redis.call('lrange', KEYS[1], -n, -1)
+if #items > 0 then
+    redis.call('ltrim', KEYS[1], 0, -n - 1)
+    if redis.call('exists', KEYS[2]) == 1 then
+        for i = 1, #items, 1000 do
+            redis.call('srem', KEYS[2], unpack(items, i, math.min(i + 999, #items)))
+        end
+    end
+end
+return items
+'''
+
+
+def rpopn(r: redis.Redis, n: int, qname: str, script: Script | None = None) -> Any:  # type: ignore
+    """pop n items from redis list queue and remove them from pending set of the queue.
+    `script` is `RPOPN_SCRIPT` registered in `r`"""
+
+    if script is None:
+        script = r.register_script(RPOPN_SCRIPT)
+    return script(keys=[qname, get_pending_key(qname)], args=[n])
 
 Task = Callable[[Any], Any]
 Tasks = dict[str, Task]
 
+SHUTDOWN_SIGNALS = (signal.SIGTERM, signal.SIGINT)
+
 class Dispenser:
     """
     Dispenser.
@@ -68,11 +108,25 @@ class Dispenser:
     :param redis_start: start redis server on beckground if `True`
     :param procs_number: Spawn workers pool for tasks functions if procs_number > 0 else use main loop process.
     :param on_error: handler for errors occured during task execution
+    :param dedup: Queues names to deduplicate. Identical tasks popped in one batch are collapsed.
+    :param shutdown_timeout: Seconds to wait for batches being processed in workers pool on exit.
+        Unfinished batches are returned to their queues.
+    :param flush_on_shutdown: Process accumulated partial batches immediately on SIGTERM/SIGINT
+        instead of leaving them in queues.
+    :param prefetch: If procs_number == 0 then run tasks functions in background thread and pop
+        up to `prefetch` next batches while current batch is processed. Disabled if 0.
+    :param priorities: Queues priorities. Ready batches of queues with higher priority are dispatched before
+        any batch of queues with lower priority. 0 by default.
+    :param rate_limits: Queues rate limits. Ready batch is held in queue until its rate limit allows to dispatch it.
+    :param hooks: Hooks called with timings of batch processing stages. Closed on exit.
     """
     def __init__(
             self, tasks: Tasks, batch_size: int, flush_interval: float,
             host: str = '127.0.0.1', port: int = 6379, password: str | None = None,
-            redis_start: bool = False, procs_number: int = 0, on_error: ErrorHandler | str | None = None):
+            redis_start: bool = False, procs_number: int = 0, on_error: ErrorHandler | str | None = None,
+            dedup: Collection[str] = (), shutdown_timeout: float = 10., flush_on_shutdown: bool = False,
+            prefetch: int = 0, priorities: dict[str, int] | None = None, rate_limits: dict[str, RateLimit] | None = None,
+            hooks: Hooks | None = None):
 
         self.tasks = {key: ErrorWrapper(key, task) for key, task in tasks.items()}
         self.batch_size = batch_size
@@ -85,11 +139,33 @@ class Dispenser:
         self.on_error = cast(
             Callable[[BaseException], None] | None,
             get_error_handler(on_error) if isinstance(on_error, str) else on_error)
+        self.dedup = frozenset(dedup)
+        assert self.dedup <= self.tasks.keys(), f'Unknown dedup queues: {sorted(self.dedup - self.tasks.keys())}'
+        self.shutdown_timeout = shutdown_timeout
+        self.flush_on_shutdown = flush_on_shutdown
+        self.prefetch = prefetch
+        assert prefetch == 0 or procs_number == 0, f'prefetch={prefetch} requires procs_number=0, got {procs_number}'
+        self.priorities = priorities or {}
+        self.rate_limits = rate_limits or {}
+        assert self.priorities.keys() <= self.tasks.keys(), f'Unknown queues: {sorted(self.priorities.keys() - self.tasks.keys())}'
+        assert self.rate_limits.keys() <= self.tasks.keys(), f'Unknown queues: {sorted(self.rate_limits.keys() - self.tasks.keys())}'
+        self.hooks = hooks
+        self.qnames = sorted(self.tasks.keys(), key=lambda qname: -self.priorities.get(qname, 0))
 
         self._redis_ctx: _GeneratorContextManager[sp.Popen[Any] | None] | None = None
         self._redis: sp.Popen[Any] | None = None
         self._pool_ctx: mp.pool.Pool | None = None
         self._pool: mp.pool.Pool | None = None
+        # Dispatched batches in dispatch order: queue name, encoded tasks, result and prefetched task.
+        # Workers pool batches are removed by result callbacks, prefetched ones by `collect`
+        self._inflight: dict[int, tuple[str | None, list[str] | None, mp.pool.AsyncResult[Any], CancellableTask[Any] | None]] = {}
+        self._inflight_lock = threading.Lock()
+        self._inflight_ids = itertools.count()
+        self._stop = threading.Event()
+        self._force = threading.Event()
+        self._waiting = False
+        self._handlers: dict[int, Any] = {}
+        self._wakeup_channel: str | None = None
 
     def setup(self, host: str | None = None, port: int | None = None) -> None:
         """
@@ -110,17 +186,56 @@ class Dispenser:
         subscribe = [f"__keyspace@0__:{qname}" for qname in qnames]
         p.psubscribe(subscribe)  # type: ignore
         logger.info('Subscribe to redis events: %s', str(subscribe))
+
+        # `shutdown` publishes here to interrupt waiting for queues events
+        wakeup_channel = f'task_dispenser:wakeup:{uuid.uuid4().hex}'
+        p.subscribe(wakeup_channel)
+
         self.r = r
         self.p = p
+        self._wakeup_channel = wakeup_channel
+        self._rpopn = r.register_script(RPOPN_SCRIPT)
+        self.buckets: dict[str, TokenBucket] = {
+            qname: limit.create_bucket(qname, r) for qname, limit in self.rate_limits.items()}
+
+    def pop(self, qname: str, n: int) -> list[str]:
+        """
+        Pop encoded tasks batch from queue.
+
+        :param qname: queue name
+        :param n: maximum number of tasks
+        """
+
+        items = cast(list[str], rpopn(self.r, n, qname, self._rpopn))
+        return dedup_items(items) if qname in self.dedup else items
 
-    def apply_task(self, task: Task, batch: list[Any]) -> None:
+    def requeue(self, qname: str, items: list[str]) -> None:
+        """
+        Return popped encoded tasks to queue, so they are popped first again.
+
+        :param qname: queue name
+        :param items: encoded tasks in order returned by `pop`
+        """
+
+        with self.r.pipeline(transaction=True) as pipe:
+            pipe.rpush(qname, *items)
+            pipe.sadd(get_pending_key(qname), *items)
+            pipe.execute()
+
+    def apply_task(self, task: Task, batch: list[Any], qname: str | None = None, items: list[str] | None = None) -> None:
         """
         Execute tasks batch.
 
         :param task: task executor
         :param batch: list of accumulated arguments
+        :param qname: queue name the batch popped from
+        :param items: encoded batch. If given with `qname` then batch is returned to queue
+            when workers pool does not process it before shutdown.
         """
 
+        hooks = self.hooks
+        start = time.time() if hooks is not None else 0.
+
         if self._pool is None:
             try:
                 task(batch)
@@ -129,8 +244,144 @@ class Dispenser:
             except TaskFailed as e:
                 if self.on_error is not None:
                     self.on_error(e)
+            finally:
+                if hooks is not None:
+                    end = time.time()
+                    hooks.on_dispatch(Span('dispatch', qname, start, end, len(batch)))
+                    hooks.on_complete(Span('complete', qname, start, end, len(batch)))
+            return
+
+        # Prefetched batch not started on shutdown is cancelled, errors of prefetched batches are handled by `collect`
+        key = next(self._inflight_ids)
+        prefetched = CancellableTask(task) if self.procs_number == 0 else None
+        callback: Callable[[Any], None] | None = None
+        error_callback: Callable[[BaseException], None] | None = None
+        if prefetched is None or hooks is not None:
+            callback = functools.partial(self._on_complete, key, qname, start, len(batch), prefetched, None)
+            error_callback = functools.partial(
+                self._on_complete, key, qname, start, len(batch), prefetched, self.on_error if prefetched is None else None)
+
+        # Callback waits until the batch is registered, so it can't be removed before added
+        with self._inflight_lock:
+            res = self._pool.apply_async(prefetched or task, args=(batch,), callback=callback, error_callback=error_callback)
+            self._inflight[key] = (qname, items, res, prefetched)
+
+        if hooks is not None:
+            hooks.on_dispatch(Span('dispatch', qname, start, time.time(), len(batch)))
+
+        if self.procs_number == 0:
+            self.collect(self.prefetch)
+
+    def _on_complete(
+            self, key: int, qname: str | None, start: float, size: int, prefetched: CancellableTask[Any] | None,
+            on_error: Callable[[BaseException], None] | None, result: Any) -> None:
+        if prefetched is None:
+            with self._inflight_lock:
+                self._inflight.pop(key, None)
+        if self.hooks is not None and (prefetched is None or not prefetched.cancelled):
+            self.hooks.on_complete(Span('complete', qname, start, time.time(), size))
+        if on_error is not None:
+            on_error(result)
+
+    def collect(self, limit: int = 0) -> None:
+        """
+        Wait for prefetched batches until no more than `limit` are left and handle errors of finished ones
+        in main loop process as if tasks were executed inline.
+
+        :param limit: maximum number of batches to leave in process
+        """
+
+        while self._inflight:
+            key, (_, _, res, _) = next(iter(self._inflight.items()))
+            if len(self._inflight) <= limit and not res.ready():
+                break
+            del self._inflight[key]
+            try:
+                res.get()
+            except TaskFailed as e:
+                if self.on_error is not None:
+                    self.on_error(e)
+
+    def drain(self, timeout: float | None = None) -> None:
+        """
+        Stop workers pool waiting for batches in process. Batches not finished in `timeout` seconds
+        are returned to queues. Prefetched batch being processed in thread can't be interrupted,
+        so it is waited after timeout and only batches not started yet are returned.
+        SIGTERM/SIGINT received while waiting stops waiting, unfinished batches are still returned.
+
+        :param timeout: seconds to wait, `shutdown_timeout` by default
+        """
+
+        if self._pool is None:
+            return
+
+        self._stop.set()
+        deadline = time.time() + (self.shutdown_timeout if timeout is None else timeout)
+        self._pool.close()
+        with self._inflight_lock:
+            inflight = list(self._inflight.items())
+        try:
+            self._waiting = self._is_main_thread()
+            for _, (_, _, res, _) in inflight:
+                if self._force.is_set():
+                    break
+                res.wait(max(deadline - time.time(), 0))
+        except ShutdownRequested:
+            logger.info('Stop waiting for batches in process')
+        finally:
+            self._waiting = False
+
+        unfinished: list[tuple[str, list[str]]] = []
+        finished = {}
+        for key, (qname, items, res, prefetched) in inflight:
+            if res.ready() or (prefetched is not None and not prefetched.cancel()):
+                finished[key] = (qname, items, res, prefetched)
+            elif qname is not None and items is not None:
+                unfinished.append((qname, items))
+        self._inflight = finished
+        if unfinished and self.procs_number > 0:
+            self._pool.terminate()
+
+        # The earliest dispatched batch is pushed last to be popped first
+        for qname, items in reversed(unfinished):
+            logger.info('Return unfinished batch to queue %s: %d tasks', qname, len(items))
+            try:
+                self.requeue(qname, items)
+            except redis.RedisError:
+                logger.exception('Can\'t return batch to queue %s: %s', qname, json.dumps(items, ensure_ascii=False))
+        self._pool.join()
+
+        if self.procs_number == 0:
+            self.collect()
+        self._inflight = {}
+
+    def shutdown(self) -> None:
+        """
+        Stop `run` loop gracefully. Loop exits after current batch is dispatched.
+        Can be called from other thread.
+        """
+
+        self._stop.set()
+        if self._wakeup_channel is not None:
+            try:
+                self.r.publish(self._wakeup_channel, 'shutdown')
+            except redis.RedisError:
+                logger.exception('Can\'t wake up message loop')
+
+    def _on_signal(self, signum: int, frame: FrameType | None) -> None:
+        if self._stop.is_set():
+            logger.info('Received %s. Stopping without waiting for batches in process', signal.Signals(signum).name)
+            self._force.set()
         else:
-            self._pool.apply_async(task, args=(batch,), error_callback=self.on_error)
+            logger.info('Received %s. Shutting down', signal.Signals(signum).name)
+            self._stop.set()
+        if self._waiting:
+            raise ShutdownRequested()
+
+    @staticmethod
+    def _is_main_thread() -> bool:
+        # Signal handlers are called in main thread only, so waits in other threads are not interrupted
+        return threading.current_thread() is threading.main_thread()
 
     def __enter__(self) -> 'Dispenser':
         assert self._redis_ctx is None, self._redis_ctx
@@ -138,49 +389,100 @@ class Dispenser:
         assert self._pool_ctx is None, self._pool_ctx
         assert self._pool is None, self._pool
 
+        self._stop.clear()
+        self._force.clear()
+        # Handlers are kept until workers pool is drained, so signals can't interrupt returning of unfinished batches
+        if self._is_main_thread():
+            self._handlers = {signum: signal.signal(signum, self._on_signal) for signum in SHUTDOWN_SIGNALS}
+
         self._redis_ctx = (start_redis(port=self.port, password=self.password) if self.redis_start else noop_ctx())
         self._redis = self._redis_ctx.__enter__()
 
         if self.procs_number > 0:
-            self._pool_ctx = mp.Pool(self.procs_number)
+            # Workers finish their batches on Ctrl-C, the main process decides what to wait for
+            self._pool_ctx = mp.Pool(self.procs_number, initializer=signal.signal, initargs=(signal.SIGINT, signal.SIG_IGN))
             self._pool = self._pool_ctx.__enter__()
             logger.info('Workers pool created: procs_number=%d', self.procs_number)
+        elif self.prefetch > 0:
+            self._pool_ctx = mp.pool.ThreadPool(1)
+            self._pool = self._pool_ctx.__enter__()
+            logger.info('Prefetch thread created: prefetch=%d', self.prefetch)
 
         self.setup()
         return self
 
     def __exit__(self, exc_type: type[BaseException] | None, exc_val: BaseException | None, exc_tb: TracebackType | None) -> None:
-        if self._redis_ctx is not None:
-            self._redis_ctx.__exit__(exc_type, exc_val, exc_tb)
+        try:
+            if self._pool_ctx is not None:
+                try:
+                    self.drain()
+                finally:
+                    self._pool_ctx.__exit__(exc_type, exc_val, exc_tb)
+                    logger.info('Workers pool closed')
+            if self.hooks is not None:
+                self.hooks.close()
+        finally:
+            try:
+                if self._redis_ctx is not None:
+                    self._redis_ctx.__exit__(exc_type, exc_val, exc_tb)
+            finally:
+                for signum, handler in self._handlers.items():
+                    signal.signal(signum, handler)
+                self._handlers = {}
+                self._redis_ctx = self._redis = self._pool_ctx = self._pool = None
 
     def run(self) -> None:
         '''
-        Start executor.
+        Start executor. Stops on SIGTERM/SIGINT received in dispenser context or `shutdown` call.
         '''
 
-        llens: dict[str, int] = {qname: self.r.llen(qname) for qname in self.tasks.keys()}
+        # Queues are checked in priority order
+        llens: dict[str, int] = {qname: self.r.llen(qname) for qname in self.qnames}
         logger.info('Queues state: %s', str(llens))
-        next_flush_times = {qname: None if llens[qname] == 0 else time.time() + self.flush_interval for qname in self.tasks.keys()}
+        next_flush_times = {qname: None if llens[qname] == 0 else time.time() + self.flush_interval for qname in self.qnames}
+        throttled: dict[str, float] = {}
 
         logger.info('Starting message loop')
-        while True:
-            delay, now = get_delay(self.flush_interval, next_flush_times, max(llens.values()))
+        while not self._stop.is_set():
+            delay, now = get_delay(self.flush_interval, next_flush_times, max(llens.values()), throttled=throttled)
             logger.debug('Wait delay %s', str(delay))
 
-            if (delay is None or delay > 0) and max(llens.values()) < self.batch_size:
-                message = self.p.get_message(timeout=delay)  # type: ignore
+            is_full = any(llen >= self.batch_size and qname not in throttled for qname, llen in llens.items())
+            if (delay is None or delay > 0) and not is_full:
+                try:
+                    self._waiting = self._is_main_thread()
+                    if self._stop.is_set():
+                        break
+                    if self.hooks is None:
+                        message = self.p.get_message(timeout=delay)  # type: ignore
+                    else:
+                        start = time.time()
+                        message = self.p.get_message(timeout=delay)  # type: ignore
+                        self.hooks.on_wait(Span('wait', None, start, time.time()))
+                except ShutdownRequested:
+                    break
+                finally:
+                    self._waiting = False
+
                 if message is None:
                     logger.debug('Check by timeout')
-                elif message['data'] != 'lpush':
+                elif message['data'] not in ('lpush', 'rpush'):
                     logger.debug('Skip message by type: %s', str(message))
                     continue
                 else:
                     _, cur_qname = message['channel'].split(':', 1)
-                    llens[cur_qname] += 1
-                    if llens[cur_qname] == 1:
+                    if message['data'] == 'lpush':
+                        llens[cur_qname] += 1
+                    else:
+                        # Returned batch is pushed by one command, so event doesn't tell number of tasks
+                        llens[cur_qname] = self.r.llen(cur_qname)
+                    if llens[cur_qname] > 0 and next_flush_times[cur_qname] is None:
                         next_flush_times[cur_qname] = time.time() + self.flush_interval
 
             for qname, llen in llens.items():
+                if self._stop.is_set():
+                    break
+
                 now = time.time()
                 if llen == 0:
                     logger.debug('Nothing to do. Empty queue: %s', qname)
@@ -192,8 +494,34 @@ class Dispenser:
                         or (is_timeout := (next_flush_times[qname] is not None and now > cast(float, next_flush_times[qname])))
                     ):
                     cur_pop = min(llen, self.batch_size)
-                    items = rpopn(self.r, cur_pop, qname)
-                    argss = [json.loads(item) for item in items]
+                    if qname in self.buckets:
+                        if throttled.get(qname, now) > now:
+                            logger.debug('Rate limited. Queue: %s', qname)
+                            continue
+
+                        if (wait := self.buckets[qname].acquire(self.rate_limits[qname].cost(cur_pop), now)) > 0:
+                            logger.debug('Rate limited for %.3fs. Queue: %s', wait, qname)
+                            throttled[qname] = now + wait
+                            continue
+                        throttled.pop(qname, None)
+
+                    if self.hooks is None:
+                        items = self.pop(qname, cur_pop)
+                        argss = [json.loads(item) for item in items]
+                    else:
+                        start = time.time()
+                        items = self.pop(qname, cur_pop)
+                        popped = time.time()
+                        argss = [json.loads(item) for item in items]
+                        self.hooks.on_pop(Span('pop', qname, start, popped, len(items)))
+                        self.hooks.on_decode(Span('decode', qname, popped, time.time(), len(items)))
+
+                    if not items:
+                        # Counter is ahead of queue when returned batch is counted along with its pushes
+                        logger.debug('Queue is empty: %s', qname)
+                        llens[qname] = 0
+                        next_flush_times[qname] = None
+                        continue
 
                     logger.debug('Apply task: %s', json.dumps({
                         'qname': qname,
@@ -201,7 +529,7 @@ class Dispenser:
                         'reason': 'timeout' if is_timeout else 'batch_size',
                         'llens': llens, 'cur_pop': cur_pop,
                     }, sort_keys=True, ensure_ascii=False))
-                    self.apply_task(self.tasks[qname], argss)
+                    self.apply_task(self.tasks[qname], argss, qname, items)
 
                     llens[qname] = llen - cur_pop
 
@@ -212,6 +540,19 @@ class Dispenser:
                     else:
                         next_flush_times[qname] = None
 
+                    # Start again from the highest priority queue, so its ready batches are dispatched first
+                    break
+
                 else:
                     logger.debug('Accumulate batch. Queue: %s', qname)
 
+        logger.info('Message loop stopped')
+        if self.flush_on_shutdown:
+            for qname, llen in llens.items():
+                while llen > 0:
+                    cur_pop = min(llen, self.batch_size)
+                    items = self.pop(qname, cur_pop)
+                    llen -= cur_pop
+                    if items:
+                        logger.debug('Flush batch on shutdown: %s (%d tasks)', qname, len(items))
+                        self.apply_task(self.tasks[qname], [json.loads(item) for item in items], qname, items)
@@ -0,0 +1,186 @@
+from typing import Any
+import threading
+import logging
+import queue
+import json
+import os
+import urllib.request
+
+logger = logging.getLogger(__file__)
+
+
+class Span:
+    '''
+    Timing of batch processing stage.
+
+    :param name: stage name: `wait`, `pop`, `decode`, `dispatch` or `complete`
+    :param qname: queue name, `None` for pubsub wait
+    :param start: stage start time
+    :param end: stage end time
+    :param size: number of tasks in batch
+
+    >>> Span('pop', 'q1', 1.5, 2., 10)
+    Span(name='pop', qname='q1', duration=0.500000, size=10)
+    '''
+
+    def __init__(self, name: str, qname: str | None, start: float, end: float, size: int = 0) -> None:
+        self.name = name
+        self.qname = qname
+        self.start = start
+        self.end = end
+        self.size = size
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+    def __repr__(self) -> str:
+        return f'Span(name={self.name!r}, qname={self.qname!r}, duration={self.duration:f}, size={self.size})'
+
+
+class Hooks:
+    '''
+    Dispatch hooks. Subclass it and override methods of interesting stages.
+
+    Stages of main loop: `on_wait` for redis pubsub wait, `on_pop` for popping batch from redis,
+    `on_decode` for json decoding, `on_dispatch` for task call or submission to workers pool.
+    `on_complete` spans from dispatch to the end of task execution. If workers pool is used then `on_complete`
+    is called from pool thread.
+
+    Hooks are not called and timings are not measured if dispenser has no hooks.
+    '''
+
+    def on_wait(self, span: Span) -> None:
+        pass
+
+    def on_pop(self, span: Span) -> None:
+        pass
+
+    def on_decode(self, span: Span) -> None:
+        pass
+
+    def on_dispatch(self, span: Span) -> None:
+        pass
+
+    def on_complete(self, span: Span) -> None:
+        pass
+
+    def close(self) -> None:
+        '''
+        Called on dispenser exit.
+        '''
+
+
+class SpanExporter(Hooks):
+    '''
+    Export spans to OpenTelemetry collector using OTLP/HTTP JSON protocol.
+    Spans are sent from background thread. If collector can't keep up then spans are dropped.
+
+    :param endpoint: collector traces url
+    :param service_name: `service.name` resource attribute
+    :param batch_size: number of spans sent in one request
+    :param timeout: request timeout in seconds
+    :param flush_interval: maximum seconds between span is added and sent
+    :param max_queue_size: maximum number of spans waiting to be sent
+    '''
+
+    def __init__(
+            self, endpoint: str = 'http://localhost:4318/v1/traces', service_name: str = 'task-dispenser',
+            batch_size: int = 512, timeout: float = 1., flush_interval: float = 5., max_queue_size: int = 2048) -> None:
+        self.endpoint = endpoint
+        self.service_name = service_name
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self._queue: queue.Queue[Span | None] = queue.Queue(max_queue_size)
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+
+    def add(self, span: Span) -> None:
+        if self._thread is None:
+            # Started on first span, so the exporter can be created before workers pool is forked
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._send, name='SpanExporter', daemon=True)
+                    self._thread.start()
+
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped == 1:
+                logger.warning('Spans queue is full, spans are dropped')
+
+    on_wait = on_pop = on_decode = on_dispatch = on_complete = add
+
+    def close(self) -> None:
+        if self._thread is None:
+            return
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._thread = None
+        if self.dropped:
+            logger.warning('%d spans dropped', self.dropped)
+
+    def _send(self) -> None:
+        spans: list[Span] = []
+        while True:
+            try:
+                span = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                if spans:
+                    self.export(spans)
+                    spans = []
+                continue
+
+            if span is not None:
+                spans.append(span)
+            if spans and (span is None or len(spans) >= self.batch_size):
+                self.export(spans)
+                spans = []
+            if span is None:
+                return
+
+    def get_payload(self, spans: list[Span]) -> dict[str, Any]:
+        '''
+        OTLP JSON request body. Every span is a root span of its own trace.
+
+        >>> payload = SpanExporter().get_payload([Span('pop', 'q1', 1, 1.5, 2)])
+        >>> span = payload['resourceSpans'][0]['scopeSpans'][0]['spans'][0]
+        >>> span['name'], span['startTimeUnixNano'], span['endTimeUnixNano'], span['attributes']
+        ('pop', '1000000000', '1500000000', [{'key': 'queue', 'value': {'stringValue': 'q1'}}, {'key': 'size', 'value': {'intValue': '2'}}])
+        '''
+        return {'resourceSpans': [{
+            'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': self.service_name}}]},
+            'scopeSpans': [{
+                'scope': {'name': 'task_dispenser'},
+                'spans': [{
+                    'traceId': os.urandom(16).hex(),
+                    'spanId': os.urandom(8).hex(),
+                    'name': span.name,
+                    'kind': 1,
+                    'startTimeUnixNano': str(round(span.start * 1e9)),
+                    'endTimeUnixNano': str(round(span.end * 1e9)),
+                    'attributes': [
+                        *([{'key': 'queue', 'value': {'stringValue': span.qname}}] if span.qname is not None else []),
+                        {'key': 'size', 'value': {'intValue': str(span.size)}},
+                    ],
+                } for span in spans],
+            }],
+        }]}
+
+    def export(self, spans: list[Span]) -> None:
+        '''
+        Send spans to collector. Errors are logged and spans are dropped.
+        '''
+        request = urllib.request.Request(
+            self.endpoint, data=json.dumps(self.get_payload(spans)).encode('utf8'),
+            headers={'Content-Type': 'application/json'}, method='POST')
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout):
+                pass
+        except Exception as e:
+            # Any error including malformed response must not stop sender thread
+            logger.warning('Can\'t export %d spans to %s: %s', len(spans), self.endpoint, e)
@@ -4,6 +4,9 @@ import argparse
 import logging
 
 from task_dispenser import Dispenser, DispenserClient
+from task_dispenser.ratelimit import RateLimit
+from task_dispenser.hooks import SpanExporter
+from task_dispenser.profiling import profile
 from task_dispenser.utils import import_by_name, start_redis, noop_ctx, get_error_handler
 
 
@@ -43,6 +46,38 @@ def args_parser() -> argparse.ArgumentParser:
         '-n', '--procs-number', default=1, type=int,
         help='Spawn workers pool for tasks functions if procs_number > 0 else use main loop process')
     parser_start.add_argument('-e', '--on-error', default='fail', choices=['fail', 'log'], help='Pandler for errors occured during task execution')
+    parser_start.add_argument(
+        '-d', '--dedup', action='append', default=[], metavar='QNAME',
+        help='Queue name to deduplicate identical tasks in batch. Example: -d q1 -d q2')
+    parser_start.add_argument(
+        '-T', '--shutdown-timeout', default=10, type=float,
+        help='Seconds to wait for batches being processed by workers on shutdown. Unfinished batches are returned to queues.')
+    parser_start.add_argument(
+        '--flush-on-shutdown', default=False, action='store_true',
+        help='Process accumulated partial batches immediately on SIGTERM/SIGINT instead of leaving them in queues.')
+    parser_start.add_argument(
+        '--prefetch', default=0, type=int,
+        help='Pop up to `prefetch` next batches while current batch is processed in background thread. Requires `--procs-number 0`.')
+    parser_start.add_argument(
+        '--priority', nargs=2, action='append', default=[], metavar=('QNAME', 'PRIORITY'),
+        help='Queue priority. Ready batches of queues with higher priority are dispatched first. Example: --priority q1 10')
+    parser_start.add_argument(
+        '--rate-limit', nargs=2, action='append', default=[], metavar=('QNAME', 'RATE'),
+        help='Maximum number of tasks per second dispatched from queue. Example: --rate-limit q1 100')
+    parser_start.add_argument(
+        '--batch-rate-limit', nargs=2, action='append', default=[], metavar=('QNAME', 'RATE'),
+        help='Maximum number of batches per second dispatched from queue. Example: --batch-rate-limit q1 0.5')
+    parser_start.add_argument(
+        '--shared-rate-limits', default=False, action='store_true',
+        help='Share rate limits between dispenser instances through redis.')
+    parser_start.add_argument(
+        '--profile', default=None, metavar='PATH',
+        help=(
+            'Profile dispenser process. Files with `.prof` or `.pstats` suffix are written by cProfile,'
+            ' otherwise sampled stacks are written in flamegraph collapsed stack format.'))
+    parser_start.add_argument(
+        '--trace-endpoint', default=None, metavar='URL',
+        help='Export timings of batch processing stages to OpenTelemetry collector. Example: http://localhost:4318/v1/traces')
     parser_start.add_argument('-S', '--redis-start', default=False, action='store_true', help='Start redis server in subprocess or not.')
     parser_start.add_argument('-D', '--redis-datadir', default='/tmp/redis', help='If start redis server then you can specify path to redis data to be saved.')
     add_common_args(parser_start)
@@ -53,6 +88,9 @@ def args_parser() -> argparse.ArgumentParser:
         '-t', '--task', nargs=2, action='append',
         help='Example: -t q1 1 -t q2 2', dest='tasks', required=True)
     parser_add.add_argument('-n', '--num', default=1, type=int)
+    parser_add.add_argument(
+        '-u', '--unique', default=False, action='store_true',
+        help='Skip task if the same one is already pending.')
     add_common_args(parser_add)
     return parser
 
@@ -63,6 +101,10 @@ def parse_args() -> argparse.Namespace:
 
 def start(args: argparse.Namespace) -> None:
     tasks = {qname: import_by_name(taskname) for qname, taskname in args.tasks}
+    rate_limits = {
+        **{qname: RateLimit(float(rate), 'items', shared=args.shared_rate_limits) for qname, rate in args.rate_limit},
+        **{qname: RateLimit(float(rate), 'batches', shared=args.shared_rate_limits) for qname, rate in args.batch_rate_limit},
+    }
 
     dispenser = Dispenser(
         tasks,
@@ -74,9 +116,16 @@ def start(args: argparse.Namespace) -> None:
         redis_start=args.redis_start,
         procs_number=args.procs_number,
         on_error=args.on_error,
+        dedup=args.dedup,
+        shutdown_timeout=args.shutdown_timeout,
+        flush_on_shutdown=args.flush_on_shutdown,
+        prefetch=args.prefetch,
+        priorities={qname: int(priority) for qname, priority in args.priority},
+        rate_limits=rate_limits,
+        hooks=SpanExporter(args.trace_endpoint) if args.trace_endpoint else None,
     )
 
-    with dispenser:
+    with dispenser, (profile(args.profile) if args.profile else noop_ctx()):
         dispenser.run()
 
 
@@ -86,7 +135,7 @@ def add(args: argparse.Namespace) -> None:
 
     for n in range(args.num):
         for qname, task_args in args.tasks:
-            client.add(qname, json.loads(task_args))
+            client.add(qname, json.loads(task_args), unique=args.unique)
 
 
 def main() -> None:
@@ -0,0 +1,81 @@
+from pathlib import Path
+from typing import Generator
+from types import FrameType
+from collections import Counter
+import cProfile
+import contextlib
+import threading
+import signal
+import logging
+import sys
+
+logger = logging.getLogger(__file__)
+
+PSTATS_SUFFIXES = ('.prof', '.pstats')
+
+
+def get_stack(frame: FrameType | None) -> list[str]:
+    '''
+    Frames names from the outermost one.
+
+    >>> get_stack(sys._getframe())[-1]
+    'task_dispenser.profiling:<module>'
+    '''
+    stack = []
+    while frame is not None:
+        stack.append(f'{frame.f_globals.get("__name__", "?")}:{frame.f_code.co_name}')
+        frame = frame.f_back
+    return stack[::-1]
+
+
+@contextlib.contextmanager
+def sample_stacks(path: str | Path, interval: float = 0.005) -> Generator[Counter[str], None, None]:
+    '''
+    Sample stacks of all threads by wall clock timer and write them in collapsed stack format
+    accepted by flamegraph tools: `thread;frame;frame count`. Works in main thread only.
+
+    :param path: output file
+    :param interval: sampling interval in seconds
+    '''
+    samples: Counter[str] = Counter()
+
+    def sample(signum: int, frame: FrameType | None) -> None:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, thread_frame in sys._current_frames().items():
+            stack = get_stack(frame if ident == threading.get_ident() else thread_frame)
+            samples[';'.join([names.get(ident, str(ident)), *stack])] += 1
+
+    handler = signal.signal(signal.SIGALRM, sample)
+    signal.setitimer(signal.ITIMER_REAL, interval, interval)
+    try:
+        yield samples
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, handler)
+        with open(path, 'w') as f:
+            for stack, count in samples.most_common():
+                f.write(f'{stack} {count}\n')
+        logger.info('Profile saved: %s (%d samples)', path, samples.total())
+
+
+@contextlib.contextmanager
+def profile(path: str | Path, interval: float = 0.005) -> Generator[None, None, None]:
+    '''
+    Profile code in context. Files with `.prof` or `.pstats` suffix are written by `cProfile` and can be read by `pstats`.
+    Otherwise stacks are sampled and saved in collapsed stack format.
+
+    :param path: output file
+    :param interval: sampling interval in seconds
+    '''
+    if Path(path).suffix in PSTATS_SUFFIXES:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(path)
+            logger.info('Profile saved: %s', path)
+    else:
+        with sample_stacks(path, interval):
+            yield
@@ -0,0 +1,170 @@
+from typing import Literal
+import time
+import redis
+
+
+# Token bucket state is kept in redis hash and updated atomically using redis server time,
+# so buckets of different dispenser instances agree on the rate.
+ACQUIRE_SCRIPT = '''
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local n = tonumber(ARGV[3])
+local t = redis.call('time')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local state = redis.call('hmget', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or capacity
+local updated = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(now - updated, 0) * rate)
+local need = math.min(n, capacity)
+local wait = 0
+if tokens >= need then
+    tokens = tokens - n
+else
+    wait = (need - tokens) / rate
+end
+redis.call('hset', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('expire', KEYS[1], math.ceil((capacity - tokens) / rate) + 1)
+return tostring(wait)
+'''
+
+
+def get_ratelimit_key(qname: str) -> str:
+    '''
+    Name of redis hash with shared rate limit state of queue.
+
+    >>> get_ratelimit_key('q1')
+    'q1:ratelimit'
+    '''
+    return f'{qname}:ratelimit'
+
+
+class TokenBucket:
+    '''
+    Token bucket rate limiter.
+
+    :param rate: tokens added per second
+    :param burst: bucket capacity, `rate` by default
+
+    >>> bucket = TokenBucket(rate=2, burst=4)
+    >>> bucket.acquire(3, now=0)
+    0.0
+    >>> bucket.acquire(3, now=0)
+    1.0
+    >>> bucket.acquire(3, now=1)
+    0.0
+
+    Requests larger than capacity wait for full bucket and are charged fully,
+    so the next request waits until the debt is paid:
+
+    >>> bucket.acquire(10, now=3)
+    0.0
+    >>> bucket.acquire(1, now=3)
+    3.5
+
+    Average rate holds for requests larger than capacity:
+
+    >>> bucket, taken, now = TokenBucket(rate=5), 0, 0.
+    >>> while now < 100:
+    ...     if (wait := bucket.acquire(20, now)) == 0:
+    ...         taken += 20
+    ...     now += wait or 0.01
+    >>> taken / 100
+    5.0
+    '''
+
+    def __init__(self, rate: float, burst: float | None = None) -> None:
+        assert rate > 0, rate
+        self.rate = rate
+        self.capacity = float(burst if burst is not None else rate)
+        self.tokens = self.capacity
+        self.updated: float | None = None
+
+    def acquire(self, n: float, now: float | None = None) -> float:
+        '''
+        Take `n` tokens if available. If `n` is larger than capacity then full bucket is enough
+        and the rest is taken in debt.
+
+        :param n: number of tokens
+        :param now: current time
+        :return: 0 if tokens are taken else seconds to wait until they are available
+        '''
+        if now is None:
+            now = time.time()
+
+        need = min(n, self.capacity)
+        if self.updated is not None:
+            self.tokens = min(self.capacity, self.tokens + max(now - self.updated, 0) * self.rate)
+        self.updated = now
+
+        if self.tokens >= need:
+            self.tokens -= n
+            return 0.
+        return (need - self.tokens) / self.rate
+
+
+class RedisTokenBucket(TokenBucket):
+    '''
+    Token bucket rate limiter shared between processes through redis.
+
+    :param r: redis client
+    :param key: redis key of bucket state
+    :param rate: tokens added per second
+    :param burst: bucket capacity, `rate` by default
+    '''
+
+    def __init__(self, r: redis.Redis, key: str, rate: float, burst: float | None = None) -> None:  # type: ignore
+        super().__init__(rate, burst)
+        self.key = key
+        self._acquire = r.register_script(ACQUIRE_SCRIPT)
+
+    def acquire(self, n: float, now: float | None = None) -> float:
+        '''
+        Take `n` tokens if available, see `TokenBucket.acquire`. Redis server time is used, `now` is ignored.
+
+        :param n: number of tokens
+        :param now: ignored
+        :return: 0 if tokens are taken else seconds to wait until they are available
+        '''
+        return float(self._acquire(keys=[self.key], args=[self.rate, self.capacity, n]))
+
+
+class RateLimit:
+    '''
+    Queue rate limit.
+
+    :param rate: number of tasks (`per="items"`) or batches (`per="batches"`) per second
+    :param per: what is limited
+    :param burst: maximum number of tasks or batches dispatched at once, `rate` by default.
+        Batch of tasks larger than `burst` is dispatched when bucket is full and the next batch waits
+        until the whole batch is paid, so the average rate holds.
+    :param shared: share limit between dispenser instances through redis key `<qname>:ratelimit`
+
+    >>> RateLimit(100).cost(20), RateLimit(5, per='batches').cost(20)
+    (20, 1)
+    '''
+
+    def __init__(
+            self, rate: float, per: Literal['items', 'batches'] = 'items', burst: float | None = None,
+            shared: bool = False) -> None:
+        assert per in ('items', 'batches'), per
+        self.rate = rate
+        self.per = per
+        self.burst = burst
+        self.shared = shared
+
+    def cost(self, n: int) -> int:
+        '''
+        Number of tokens to dispatch batch of `n` tasks.
+        '''
+        return 1 if self.per == 'batches' else n
+
+    def create_bucket(self, qname: str, r: redis.Redis) -> TokenBucket:  # type: ignore
+        '''
+        Create token bucket for queue.
+
+        :param qname: queue name
+        :param r: redis client used by shared limit
+        '''
+        if self.shared:
+            return RedisTokenBucket(r, get_ratelimit_key(qname), self.rate, self.burst)
+        return TokenBucket(self.rate, self.burst)
@@ -1,6 +1,7 @@
 from pathlib import Path
 from typing import Any, Callable, ParamSpec, TypeVar, Generic, Generator
 import traceback
+import threading
 import sys
 import os
 import logging
@@ -17,6 +18,10 @@ class TaskDispenserBaseError(Exception):
     pass
 
 
+class ShutdownRequested(TaskDispenserBaseError):
+    pass
+
+
 P = ParamSpec('P')
 T = TypeVar('T')
 
@@ -47,6 +52,43 @@ class ErrorWrapper(Generic[T]):
             raise TaskFailed(e, self.queue, self.func) from e
 
 
+class CancellableTask(Generic[T]):
+    '''
+    Task which can be cancelled until it is started.
+
+    >>> task = CancellableTask(len)
+    >>> task.cancel(), task([1, 2])
+    (True, None)
+    >>> task = CancellableTask(len)
+    >>> task([1, 2]), task.cancel()
+    (2, False)
+    '''
+
+    def __init__(self, func: Callable[[Any], T]) -> None:
+        self.func = func
+        self.started = False
+        self.cancelled = False
+        self._lock = threading.Lock()
+
+    def cancel(self) -> bool:
+        '''
+        Cancel task if it is not started.
+
+        :return: `True` if task is cancelled
+        '''
+        with self._lock:
+            if not self.started:
+                self.cancelled = True
+            return self.cancelled
+
+    def __call__(self, arg: Any) -> T | None:
+        with self._lock:
+            if self.cancelled:
+                return None
+            self.started = True
+        return self.func(arg)
+
+
 def import_by_name(name: str) -> Any:
     '''
     Import object by name.
@@ -90,6 +132,26 @@ def import_by_name(name: str) -> Any:
     return res
 
 
+def get_pending_key(qname: str) -> str:
+    '''
+    Name of redis set with items pending in deduplicated queue.
+
+    >>> get_pending_key('q1')
+    'q1:pending'
+    '''
+    return f'{qname}:pending'
+
+
+def dedup_items(items: list[str]) -> list[str]:
+    '''
+    Collapse identical encoded items keeping first occurrence order.
+
+    >>> dedup_items(['"a"', '"b"', '"a"', '1', '"b"'])
+    ['"a"', '"b"', '1']
+    '''
+    return list(dict.fromkeys(items))
+
+
 @contextlib.contextmanager
 def noop_ctx(*args: Any, **kwargs: Any) -> Generator[None, None, None]:
     yield
@@ -0,0 +1,115 @@
+from typing import Any, Generator
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import StreamRequestHandler, TCPServer
+from pathlib import Path
+import threading
+import pstats
+import time
+import json
+import pytest
+
+from task_dispenser.hooks import Span, SpanExporter
+from task_dispenser.profiling import profile
+
+
+@pytest.fixture
+def collector(request: pytest.FixtureRequest) -> Generator[tuple[str, list[Any]], None, None]:
+    requests: list[Any] = []
+    delay = getattr(request, 'param', 0)
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self) -> None:
+            time.sleep(delay)
+            requests.append(json.loads(self.rfile.read(int(self.headers['Content-Length']))))
+            self.send_response(200)
+            self.end_headers()
+
+    with HTTPServer(('127.0.0.1', 0), Handler) as server:
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            yield f'http://127.0.0.1:{server.server_port}/v1/traces', requests
+        finally:
+            server.shutdown()
+            thread.join()
+
+
+def test_span_exporter(collector: tuple[str, list[Any]]) -> None:
+    endpoint, requests = collector
+    exporter = SpanExporter(endpoint, batch_size=2)
+
+    exporter.on_pop(Span('pop', 'q1', 1, 2, 3))
+    assert requests == []
+    exporter.on_decode(Span('decode', 'q1', 2, 3, 3))
+    exporter.on_wait(Span('wait', None, 3, 4))
+    exporter.close()
+
+    names = [
+        [span['name'] for span in request['resourceSpans'][0]['scopeSpans'][0]['spans']]
+        for request in requests]
+    assert names == [['pop', 'decode'], ['wait']]
+
+
+def test_span_exporter_unavailable() -> None:
+    exporter = SpanExporter('http://127.0.0.1:1/v1/traces', batch_size=1)
+    exporter.on_pop(Span('pop', 'q1', 1, 2, 3))
+    exporter.close()
+
+
+def test_span_exporter_bad_response() -> None:
+    connections: list[bytes] = []
+
+    class Handler(StreamRequestHandler):
+        def handle(self) -> None:
+            connections.append(self.rfile.readline())
+            self.wfile.write(b'garbage\r\n\r\n')
+
+    with TCPServer(('127.0.0.1', 0), Handler) as server:
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            exporter = SpanExporter(f'http://127.0.0.1:{server.server_address[1]}/v1/traces', batch_size=1)
+            exporter.on_pop(Span('pop', 'q1', 1, 2, 3))
+            exporter.on_decode(Span('decode', 'q1', 2, 3, 3))
+            exporter.close()
+        finally:
+            server.shutdown()
+            thread.join()
+
+    # Sender thread survives malformed response and exports the next batch
+    assert len(connections) == 2
+
+
+@pytest.mark.parametrize('collector', [0.5], indirect=True)
+def test_span_exporter_slow_collector(collector: tuple[str, list[Any]]) -> None:
+    endpoint, requests = collector
+    exporter = SpanExporter(endpoint, batch_size=1, max_queue_size=2)
+
+    start = time.time()
+    for i in range(5):
+        exporter.on_pop(Span('pop', 'q1', i, i + 1, 1))
+        time.sleep(0.01)
+    assert time.time() - start < 0.25
+
+    exporter.close()
+    assert exporter.dropped == 2
+    assert len(requests) == 3
+
+
+def busy_loop(seconds: float) -> None:
+    end = time.time() + seconds
+    while time.time() < end:
+        pass
+
+
+@pytest.mark.parametrize('name', ['out.prof', 'out.folded'])
+def test_profile(name: str, tmp_path: Path) -> None:
+    path = tmp_path / name
+    with profile(path):
+        busy_loop(0.2)
+
+    if path.suffix == '.prof':
+        assert any(func[2] == 'busy_loop' for func in pstats.Stats(str(path)).stats)
+    else:
+        stacks = dict(line.rsplit(' ', 1) for line in path.read_text().splitlines())
+        assert any(stack.startswith('MainThread;') and stack.endswith('test_hooks:busy_loop') for stack in stacks)
@@ -3,14 +3,17 @@ import redis
 from typing import Generator, Any
 import time
 import multiprocessing as mp
+import threading
 import sys
 import shlex
+from task_dispenser import Dispenser
+from task_dispenser.hooks import Hooks, Span
 from task_dispenser.main import main
 from task_dispenser.utils import start_redis
 import contextlib
 import json
 
-from conftest import get_global_redis_client, get_redis_results
+from conftest import get_global_redis_client, get_redis_results, GLOBAL_REDIS_CLIENT
 
 
 @contextlib.contextmanager
@@ -33,6 +36,30 @@ def log_to_redis(tasks: list[Any]) -> None:
         assert r.lpush(str(i), json.dumps(tasks))
 
 
+class SpanRecorder(Hooks):
+    def __init__(self) -> None:
+        self.spans: list[Span] = []
+        self.closed = False
+
+    def add(self, span: Span) -> None:
+        self.spans.append(span)
+
+    on_wait = on_pop = on_decode = on_dispatch = on_complete = add
+
+    def close(self) -> None:
+        self.closed = True
+
+
+def log_order_to_redis(tasks: list[Any]) -> None:
+    with get_global_redis_client() as r:
+        assert r.lpush('order', json.dumps(tasks))
+
+
+def slow_log_to_redis(tasks: list[Any]) -> None:
+    time.sleep(3)
+    log_to_redis(tasks)
+
+
 @contextlib.contextmanager
 def start_dispenser(server_args: str | list[str], wait_start: int = 1) -> Generator[None, None, None]:
     with patch_args(server_args):
@@ -84,6 +111,47 @@ def test_procs_number(procs: int, global_redis: redis.Redis) -> None:  # type: i
     assert get_redis_results(global_redis, key) == [[key] * 2] * 5
 
 
+@pytest.mark.parametrize('prefetch', [1, 2])
+def test_prefetch(prefetch: int, global_redis: redis.Redis) -> None:  # type: ignore
+    key = 't'
+    server_args = DISPENSER_DEFAULT_ARGS + f'--batch-size 2 --flush-interval 1 --procs-number 0 --prefetch {prefetch}'
+    add_args = f'''task-dispenser add -t q1 '"{key}"' --log-level=debug -n 10'''
+
+    with start_dispenser(server_args):
+        with patch_args(add_args):
+            main()
+        time.sleep(1)
+
+    assert get_redis_results(global_redis, key) == [[key] * 2] * 5
+
+
+def sleep_task(batch: list[Any]) -> None:
+    time.sleep(0.3)
+
+
+def test_prefetch_with_pool() -> None:
+    with pytest.raises(AssertionError, match='requires procs_number=0'):
+        Dispenser({'q1': print}, batch_size=1, flush_interval=1, procs_number=1, prefetch=2)
+
+
+def test_prefetch_overlap(global_redis: redis.Redis) -> None:  # type: ignore
+    assert global_redis.lpush('pf', *[json.dumps(i) for i in range(3)])
+    recorder = SpanRecorder()
+    dispenser = Dispenser(
+        {'pf': sleep_task}, batch_size=1, flush_interval=100, port=GLOBAL_REDIS_CLIENT, prefetch=1, hooks=recorder)
+
+    with dispenser:
+        threading.Timer(1.5, dispenser.shutdown).start()
+        dispenser.run()
+
+    pops = [span for span in recorder.spans if span.name == 'pop']
+    completes = [span for span in recorder.spans if span.name == 'complete']
+    assert len(pops) == len(completes) == 3
+    # The next batch is popped while the previous one is handled
+    assert pops[1].end < completes[0].end
+    assert pops[2].end < completes[1].end
+
+
 def test_auth(global_redis: redis.Redis) -> None:  # type: ignore
     key = 't'
     server_args = DISPENSER_DEFAULT_ARGS + f'--batch-size 2 --flush-interval 1 --redis-pass p'
@@ -108,3 +176,206 @@ def test_auth(global_redis: redis.Redis) -> None:  # type: ignore
                 main()
         time.sleep(1)
         assert get_redis_results(global_redis, key) == []
+
+
+@pytest.mark.parametrize('unique', [False, True])
+def test_dedup(unique: bool, global_redis: redis.Redis) -> None:  # type: ignore
+    server_args = DISPENSER_DEFAULT_ARGS + '--batch-size 100 --flush-interval 1 --dedup q1'
+    add_args = '''task-dispenser add -t q1 '"t"' -t q1 '"u"' --log-level=debug -n 5''' + (' --unique' if unique else '')
+
+    with start_dispenser(server_args), redis.Redis(decode_responses=True) as r:
+        with patch_args(add_args):
+            main()
+        if unique:
+            assert r.llen('q1') == 2
+            assert r.smembers('q1:pending') == {'"t"', '"u"'}
+        time.sleep(2)
+        assert r.scard('q1:pending') == 0
+
+    assert get_redis_results(global_redis, 'u') == [['u', 't']]
+
+
+def test_unique_without_dedup(global_redis: redis.Redis) -> None:  # type: ignore
+    key = 't'
+    add_args = f'''task-dispenser add -t q1 '"{key}"' --log-level=debug -n 3 --unique'''
+
+    with start_dispenser(DISPENSER_DEFAULT_ARGS + '--batch-size 100 --flush-interval 1'):
+        for _ in range(2):
+            with patch_args(add_args):
+                main()
+            time.sleep(2)
+
+    assert get_redis_results(global_redis, key) == [[key], [key]]
+
+
+def test_flush_on_shutdown(global_redis: redis.Redis) -> None:  # type: ignore
+    key = 't'
+    server_args = DISPENSER_DEFAULT_ARGS + '--batch-size 4 --flush-interval 100 --flush-on-shutdown'
+    add_args = f'''task-dispenser add -t q1 '"{key}"' --log-level=debug -n 10'''
+
+    with start_dispenser(server_args):
+        with patch_args(add_args):
+            main()
+        time.sleep(1)
+        assert get_redis_results(global_redis, key) == [[key] * 4] * 2
+
+    assert get_redis_results(global_redis, key) == [[key] * 2]
+
+
+@pytest.mark.parametrize('run_in_thread', [False, True])
+def test_shutdown_call(run_in_thread: bool, global_redis: redis.Redis) -> None:  # type: ignore
+    dispenser = Dispenser({'empty': print}, batch_size=2, flush_interval=100, port=GLOBAL_REDIS_CLIENT)
+
+    with dispenser:
+        start = time.time()
+        if run_in_thread:
+            thread = threading.Thread(target=dispenser.run)
+            thread.start()
+            time.sleep(0.5)
+            dispenser.shutdown()
+            thread.join(timeout=2)
+            assert not thread.is_alive()
+        else:
+            threading.Timer(0.5, dispenser.shutdown).start()
+            dispenser.run()
+
+    assert time.time() - start < 2
+
+
+@pytest.mark.parametrize('mode, processed, returned', [
+    # Workers are terminated, all batches are returned
+    ('--procs-number 1', 0, 6),
+    # The first batch blocks prefetch, the second one is running on shutdown and the third one is not started
+    ('--procs-number 0 --prefetch 2', 2, 2),
+])
+def test_shutdown_requeue(mode: str, processed: int, returned: int, global_redis: redis.Redis) -> None:  # type: ignore
+    key = 't'
+    server_args = f'''task-dispenser start -t q1 tests/test_main.py:slow_log_to_redis
+        --redis-port {GLOBAL_REDIS_CLIENT} {mode} --batch-size 2 --flush-interval 100
+        --shutdown-timeout 0.5 --log-level=debug'''
+    add_args = f'''task-dispenser add -t q1 '"{key}"' --redis-port {GLOBAL_REDIS_CLIENT} --log-level=debug -n 6'''
+
+    with start_dispenser(server_args):
+        with patch_args(add_args):
+            main()
+        time.sleep(0.5)
+        assert global_redis.llen('q1') == 0
+
+    assert get_redis_results(global_redis, key) == [[key] * 2] * processed
+    assert get_redis_results(global_redis, 'q1') == [key] * returned
+
+
+def test_shutdown_force(global_redis: redis.Redis) -> None:  # type: ignore
+    key = 'f'
+    server_args = f'''task-dispenser start -t q1 tests/test_main.py:slow_log_to_redis
+        --redis-port {GLOBAL_REDIS_CLIENT} --procs-number 1 --batch-size 2 --flush-interval 100
+        --shutdown-timeout 100 --log-level=debug'''
+    add_args = f'''task-dispenser add -t q1 '"{key}"' --redis-port {GLOBAL_REDIS_CLIENT} --log-level=debug -n 4'''
+
+    with patch_args(server_args):
+        p = mp.Process(target=main)
+        p.start()
+    try:
+        time.sleep(1)
+        with patch_args(add_args):
+            main()
+        time.sleep(0.5)
+
+        # The second signal skips waiting for workers, but batches are still returned
+        p.terminate()
+        time.sleep(0.5)
+        p.terminate()
+        p.join(timeout=2)
+        assert not p.is_alive()
+    finally:
+        p.kill()
+        p.join()
+
+    assert get_redis_results(global_redis, key) == []
+    assert get_redis_results(global_redis, 'q1') == [key] * 4
+
+
+def test_requeued_batch_counted(global_redis: redis.Redis) -> None:  # type: ignore
+    key = 'r'
+    dispenser = Dispenser({'q1': log_to_redis}, batch_size=2, flush_interval=100, port=GLOBAL_REDIS_CLIENT)
+
+    with dispenser:
+        # Full batch pushed back by one command is dispatched without waiting for flush
+        threading.Timer(0.5, dispenser.requeue, args=('q1', [json.dumps(key)] * 2)).start()
+        threading.Timer(1.5, dispenser.shutdown).start()
+        dispenser.run()
+
+    assert get_redis_results(global_redis, key) == [[key] * 2]
+
+
+@pytest.mark.parametrize('limit, batches', [
+    ('--rate-limit q1 2', 2),
+    ('--batch-rate-limit q1 1', 2),
+    ('--batch-rate-limit q1 1 --shared-rate-limits', 2),
+    # Batches are larger than burst, one batch per 2 seconds
+    ('--rate-limit q1 1', 1),
+    ('--rate-limit q1 1 --shared-rate-limits', 1),
+])
+def test_rate_limit(limit: str, batches: int, global_redis: redis.Redis) -> None:  # type: ignore
+    key = 't'
+    server_args = DISPENSER_DEFAULT_ARGS + f'--batch-size 2 --flush-interval 100 {limit}'
+    add_args = f'''task-dispenser add -t q1 '"{key}"' --log-level=debug -n 8'''
+
+    with start_dispenser(server_args):
+        with patch_args(add_args):
+            main()
+        time.sleep(1.5)
+        assert get_redis_results(global_redis, key) == [[key] * 2] * batches
+        time.sleep(2)
+
+    assert get_redis_results(global_redis, key) == [[key] * 2] * batches
+
+
+def test_priority(global_redis: redis.Redis) -> None:  # type: ignore
+    for qname, key, n in [('q1', 'a', 2), ('q2', 'b', 6), ('q3', 'c', 4)]:
+        assert global_redis.lpush(qname, *[json.dumps(key)] * n)
+
+    server_args = f'''task-dispenser start
+        -t q1 tests/test_main.py:log_order_to_redis
+        -t q2 tests/test_main.py:log_order_to_redis
+        -t q3 tests/test_main.py:log_order_to_redis
+        --redis-port {GLOBAL_REDIS_CLIENT} --procs-number 0 --batch-size 2 --flush-interval 100
+        --priority q2 2 --priority q3 1 --log-level=debug'''
+
+    with start_dispenser(server_args):
+        pass
+
+    assert get_redis_results(global_redis, 'order') == [['b', 'b']] * 3 + [['c', 'c']] * 2 + [['a', 'a']]
+
+
+def noop_task(batch: list[Any]) -> None:
+    pass
+
+
+@pytest.mark.parametrize('procs, prefetch', [(0, 0), (1, 0), (0, 1)])
+def test_hooks(procs: int, prefetch: int, global_redis: redis.Redis) -> None:  # type: ignore
+    assert global_redis.lpush('hk', *[json.dumps(i) for i in range(5)])
+    recorder = SpanRecorder()
+    dispenser = Dispenser(
+        {'hk': noop_task}, batch_size=2, flush_interval=0.5, port=GLOBAL_REDIS_CLIENT,
+        procs_number=procs, prefetch=prefetch, hooks=recorder)
+
+    with dispenser:
+        threading.Timer(1.5, dispenser.shutdown).start()
+        dispenser.run()
+
+    assert recorder.closed
+    assert any(span.name == 'wait' and span.qname is None for span in recorder.spans)
+
+    spans = [span for span in recorder.spans if span.name != 'wait']
+    assert {span.qname for span in spans} == {'hk'}
+    for name in ['pop', 'decode', 'dispatch', 'complete']:
+        assert [span.size for span in spans if span.name == name] == [2, 2, 1], name
+
+    main_loop = [span.name for span in spans if span.name != 'complete']
+    assert main_loop == ['pop', 'decode', 'dispatch'] * 3
+    stages = [[span for span in spans if span.name == name] for name in ['pop', 'decode', 'dispatch', 'complete']]
+    for pop, decode, dispatch, complete in zip(*stages):
+        assert pop.start <= pop.end <= decode.start <= decode.end <= dispatch.start <= dispatch.end
+        assert complete.start == dispatch.start
+        assert complete.end >= complete.start